@@ -12,13 +12,23 @@ import sys
 
 packages = [
     "git+https://github.com/huggingface/trl.git",
-    "bitsandbytes", "peft", "qwen-vl-utils",
-    "geopandas", "rasterio", "folium", "pillow", "requests",
+    "qwen-vl-utils",
+    "geopandas", "pyogrio", "pyarrow", "rasterio", "folium", "pillow", "requests",
     "datasets", "transformers", "accelerate"
 ]
 
-for package in packages:
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "-U", "-q", package])
+# Their dependencies are covered by Colab's base image and the list above
+no_deps_packages = ["bitsandbytes", "peft"]
+
+# One pip call per group instead of per package
+subprocess.check_call([sys.executable, "-m", "pip", "install", "-U", "-q", *packages])
+subprocess.check_call([sys.executable, "-m", "pip", "install", "-U", "-q", "--no-deps", *no_deps_packages])
+
+# FlashAttention-2 needs to build against the installed torch; optional
+try:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "-q", "flash-attn", "--no-build-isolation"])
+except subprocess.CalledProcessError:
+    print("⚠️ flash-attn not available, falling back to SDPA attention")
 
 print("✅ Dependencies installed!")
 
@@ -28,15 +38,23 @@ print("✅ Dependencies installed!")
 import os
 import gc
 import time
+import threading
+
+# Allocator config must be set before CUDA is initialized to take effect
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
 import torch
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyogrio
+import shapely
 from PIL import Image
 import requests
 from io import BytesIO
 import zipfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Optional
 
 # Hugging Face imports
@@ -50,9 +68,29 @@ from peft import LoraConfig, get_peft_model
 from trl import SFTConfig, SFTTrainer
 from qwen_vl_utils import process_vision_info
 
+# Prefer FlashAttention-2, fall back to PyTorch's fused SDPA kernels
+try:
+    import flash_attn
+    attn_implementation = "flash_attention_2"
+except ImportError:
+    attn_implementation = "sdpa"
+
+# Processors are shared by training and inference, so load each one only once
+_PROCESSORS = {}
+
+def get_processor(model_id: str = "Qwen/Qwen2-VL-7B-Instruct"):
+    """Return the cached Qwen2-VL processor for a model, loading it on first use"""
+    if model_id not in _PROCESSORS:
+        _PROCESSORS[model_id] = Qwen2VLProcessor.from_pretrained(model_id)
+    return _PROCESSORS[model_id]
+
+# Read shapefiles through pyogrio (vectorized GDAL reads) instead of Fiona
+gpd.options.io_engine = "pyogrio"
+
 # Check GPU
 print(f"🚀 GPU: {torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'None'}")
 print(f"💾 Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+print(f"⚡ Attention: {attn_implementation}")
 
 if not torch.cuda.is_available():
     print("❌ No GPU detected! Please use A100 GPU runtime.")
@@ -153,26 +191,63 @@ class VacantLandProcessor:
             'ZZ': 'Zhengzhou', 'ZB': 'Zibo', 'ZS': 'Zhongshan', 'ZH': 'Zhuhai'
         }
     
+    def find_city_shapefile(self, city_code: str):
+        """Locate the vacant land shapefile for a city"""
+        # Try both structures: city_code/city_code_VL.shp and city_code_VL.shp
+        vacant_path1 = self.data_path / city_code / f"{city_code}_VL.shp"  # In subdirectory
+        vacant_path2 = self.data_path / f"{city_code}_VL.shp"  # In main directory
+        
+        if vacant_path1.exists():
+            return vacant_path1
+        elif vacant_path2.exists():
+            return vacant_path2
+        return None
+    
     def load_city_data(self, city_code: str):
-        """Load vacant land shapefile for a city"""
+        """Load vacant land centroids and areas for a city"""
         try:
-            # Try both structures: city_code/city_code_VL.shp and city_code_VL.shp
-            vacant_path1 = self.data_path / city_code / f"{city_code}_VL.shp"  # In subdirectory
-            vacant_path2 = self.data_path / f"{city_code}_VL.shp"  # In main directory
-            
-            if vacant_path1.exists():
-                vacant_path = vacant_path1
-            elif vacant_path2.exists():
-                vacant_path = vacant_path2
-            else:
+            vacant_path = self.find_city_shapefile(city_code)
+            if vacant_path is None:
                 print(f"⚠️ {city_code}_VL.shp not found in {city_code}/ or main directory")
                 return None
+            
+            # Centroids and areas only change with the shapefile, so reuse the cached copy;
+            # keying on its mtime and size means a replaced shapefile misses the cache
+            stat = vacant_path.stat()
+            cache_path = self.data_path / ".cache" / f"{city_code}_{stat.st_mtime_ns}_{stat.st_size}.parquet"
+            if cache_path.exists():
+                vacant_gdf = gpd.read_parquet(cache_path)
+                print(f"✅ {city_code}: {len(vacant_gdf)} vacant areas loaded (cached)")
+                return vacant_gdf
                 
-            vacant_gdf = gpd.read_file(vacant_path)
+            # Only geometry is used downstream; read it as Arrow batches
+            vacant_gdf = gpd.read_file(
+                vacant_path,
+                engine="pyogrio",
+                use_arrow=True,
+                columns=["geometry"]
+            )
             
             # Convert to WGS84 if needed
             if vacant_gdf.crs != 'EPSG:4326':
                 vacant_gdf = vacant_gdf.to_crs('EPSG:4326')
+            
+            # Keep only centroids and areas; the polygons aren't needed downstream
+            geoms = vacant_gdf.geometry.values
+            vacant_gdf = gpd.GeoDataFrame(
+                {'area_sqm': shapely.area(geoms) * 111000 * 111000},  # rough conversion
+                geometry=shapely.centroid(geoms),
+                crs=vacant_gdf.crs
+            )
+            
+            # Caching is best-effort; the loaded data is still usable if the write fails
+            try:
+                cache_path.parent.mkdir(exist_ok=True)
+                for stale_path in cache_path.parent.glob(f"{city_code}_[0-9]*_[0-9]*.parquet"):
+                    stale_path.unlink()
+                vacant_gdf.to_parquet(cache_path)
+            except Exception as e:
+                print(f"⚠️ Could not cache {city_code}: {e}")
                 
             print(f"✅ {city_code}: {len(vacant_gdf)} vacant areas loaded")
             return vacant_gdf
@@ -187,36 +262,45 @@ class VacantLandProcessor:
         if vacant_gdf is None or len(vacant_gdf) == 0:
             return []
         
+        # Empty or missing geometries have no coordinates; skip them instead of failing the city
+        geoms = vacant_gdf.geometry.values
+        invalid = shapely.is_empty(geoms) | shapely.is_missing(geoms)
+        if invalid.any():
+            print(f"⚠️ Skipping {int(invalid.sum())} empty geometries in {city_code}")
+            vacant_gdf = vacant_gdf[~invalid]
+            if len(vacant_gdf) == 0:
+                return []
+        
         # Sample random areas
         n_samples = min(n_samples, len(vacant_gdf))
         sampled = vacant_gdf.sample(n=n_samples, random_state=42)
         
-        samples = []
-        for idx, row in sampled.iterrows():
-            try:
-                centroid = row.geometry.centroid
-                
-                # Create bounding box (~500m x 500m)
-                buffer_size = 0.0045  # degrees (~500m)
-                bbox = [
-                    centroid.x - buffer_size,  # west
-                    centroid.y - buffer_size,  # south
-                    centroid.x + buffer_size,  # east
-                    centroid.y + buffer_size   # north
-                ]
-                
-                samples.append({
-                    'city_code': city_code,
-                    'city_name': self.cities[city_code],
-                    'bbox': bbox,
-                    'area_sqm': row.geometry.area * 111000 * 111000,  # rough conversion
-                    'centroid_lat': centroid.y,
-                    'centroid_lon': centroid.x
-                })
-                
-            except Exception as e:
-                print(f"⚠️ Error processing area in {city_code}: {e}")
-                continue
+        # Read centroid coordinates and areas for all sampled rows in one pass
+        centroids = sampled.geometry.values
+        cx = shapely.get_x(centroids)
+        cy = shapely.get_y(centroids)
+        areas = sampled['area_sqm'].to_numpy()
+        
+        # Create bounding boxes (~500m x 500m)
+        buffer_size = 0.0045  # degrees (~500m)
+        bboxes = np.stack([
+            cx - buffer_size,  # west
+            cy - buffer_size,  # south
+            cx + buffer_size,  # east
+            cy + buffer_size   # north
+        ], axis=1)
+        
+        samples = [
+            {
+                'city_code': city_code,
+                'city_name': self.cities[city_code],
+                'bbox': bbox.tolist(),
+                'area_sqm': float(area),
+                'centroid_lat': float(lat),
+                'centroid_lon': float(lon)
+            }
+            for bbox, area, lat, lon in zip(bboxes, areas, cy, cx)
+        ]
         
         return samples
 
@@ -295,9 +379,15 @@ if processor:
     print("\n🌍 Testing other cities...")
     test_cities = ['SH', 'GZ', 'SZ', 'CD', 'TJ']  # Mix of common cities
     for city in test_cities:
-        samples = processor.sample_vacant_areas(city, n_samples=1)
-        if samples:
-            print(f"✅ {city}: OK ({len(samples)} samples)")
+        # Metadata-only check; avoids reading every geometry just to smoke test
+        shp_path = processor.find_city_shapefile(city)
+        try:
+            n_features = pyogrio.read_info(shp_path)["features"] if shp_path else 0
+        except Exception as e:
+            print(f"⚠️ {city}: {e}")
+            n_features = 0
+        if n_features > 0:
+            print(f"✅ {city}: OK ({n_features} features)")
         else:
             print(f"❌ {city}: Failed")
 else:
@@ -309,6 +399,16 @@ else:
 class SatelliteFetcher:
     def __init__(self):
         self.tile_url = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
+        
+        # Reuse keep-alive connections across tile requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        
+        # On-disk tile cache so repeated (z, x, y) tiles never hit the network
+        self.cache_dir = Path("/content/tile_cache")
+        self.cache_dir.mkdir(exist_ok=True)
     
     def deg2num(self, lat_deg: float, lon_deg: float, zoom: int):
         """Convert lat/lon to tile coordinates"""
@@ -319,22 +419,39 @@ class SatelliteFetcher:
         ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
         return (xtile, ytile)
     
-    def fetch_image(self, bbox: List[float], zoom: int = 17):
-        """Fetch satellite image for bounding box"""
+    def bbox_to_tile(self, bbox: List[float], zoom: int = 17):
+        """Get the (x, y) tile containing the center of a bounding box"""
+        west, south, east, north = bbox
+        center_lat = (south + north) / 2
+        center_lon = (west + east) / 2
+        return self.deg2num(center_lat, center_lon, zoom)
+    
+    def fetch_tile(self, x: int, y: int, zoom: int = 17):
+        """Fetch a single satellite tile by tile coordinates"""
         try:
-            west, south, east, north = bbox
-            center_lat = (south + north) / 2
-            center_lon = (west + east) / 2
+            # Serve from cache if this tile was fetched before
+            cache_path = self.cache_dir / f"{zoom}_{x}_{y}.jpg"
+            if cache_path.exists():
+                try:
+                    return Image.open(cache_path).convert('RGB')
+                except Exception:
+                    # Unreadable cache entry; drop it and fetch the tile again
+                    cache_path.unlink(missing_ok=True)
             
-            # Get tile coordinates
-            x, y = self.deg2num(center_lat, center_lon, zoom)
             url = self.tile_url.format(x=x, y=y, z=zoom)
             
             # Fetch image
-            response = requests.get(url, timeout=10)
+            response = self.session.get(url, timeout=10)
             if response.status_code == 200:
-                image = Image.open(BytesIO(response.content))
-                return image.convert('RGB')
+                # Decode before caching so truncated or non-image responses never reach the cache
+                image = Image.open(BytesIO(response.content)).convert('RGB')
+                
+                # Write atomically (tmp + rename) so concurrent fetches never see partial files
+                tmp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+                tmp_path.write_bytes(response.content)
+                os.replace(tmp_path, cache_path)
+                
+                return image
             else:
                 print(f"⚠️ Failed to fetch image: HTTP {response.status_code}")
                 return None
@@ -342,6 +459,15 @@ class SatelliteFetcher:
         except Exception as e:
             print(f"❌ Error fetching image: {e}")
             return None
+    
+    def fetch_image(self, bbox: List[float], zoom: int = 17):
+        """Fetch satellite image for bounding box"""
+        try:
+            x, y = self.bbox_to_tile(bbox, zoom)
+        except Exception as e:
+            print(f"❌ Error fetching image: {e}")
+            return None
+        return self.fetch_tile(x, y, zoom)
 
 print("✅ SatelliteFetcher class defined!")
 
@@ -405,13 +531,12 @@ def create_training_dataset():
     images_dir = output_path / "images"
     images_dir.mkdir(parents=True, exist_ok=True)
     
-    dataset_samples = []
-    
     # Process cities (start with fewer for testing)
     # Use cities that we know exist in the dataset
     cities_to_process = ['CC', 'BJ', 'SH', 'GZ']  # Start with 4 cities, CC first since we saw it
     
-    for city_code in cities_to_process:
+    def process_city(city_code):
+        """Sample vacant areas for one city"""
         print(f"\n🏙️ Processing {city_code} ({processor.cities.get(city_code, city_code)})...")
         
         # Get vacant land samples
@@ -419,23 +544,57 @@ def create_training_dataset():
         
         if not vacant_samples:
             print(f"⚠️ No samples found for {city_code}")
-            continue
-        
+        return vacant_samples
+    
+    # Shapefile reads (GDAL) release the GIL, so cities load concurrently
+    with ThreadPoolExecutor(max_workers=len(cities_to_process)) as executor:
+        city_samples = list(executor.map(process_city, cities_to_process))
+    
+    # Gather every positive/negative bbox pair before touching the network
+    jobs = []
+    for city_code, vacant_samples in zip(cities_to_process, city_samples):
         for i, sample in enumerate(vacant_samples):
+            bbox_shifted = [b + 0.008 for b in sample['bbox']]  # Shift ~900m
+            jobs.append((city_code, i, sample, bbox_shifted))
+    
+    # Resolve tile coordinates first so duplicate tiles are fetched only once
+    zoom = 17
+    resolved_jobs = []
+    tile_pairs = []
+    for job in jobs:
+        city_code, i, sample, bbox_shifted = job
+        try:
+            tile_pair = (fetcher.bbox_to_tile(sample['bbox'], zoom), fetcher.bbox_to_tile(bbox_shifted, zoom))
+        except Exception as e:
+            print(f"  ⚠️ Skipping {city_code}_{i}: invalid bbox ({e})")
+            continue
+        resolved_jobs.append(job)
+        tile_pairs.append(tile_pair)
+    jobs = resolved_jobs
+    unique_tiles = list(dict.fromkeys(tile for pair in tile_pairs for tile in pair))
+    
+    # Fetch all unique tiles concurrently over the fetcher's pooled session
+    print(f"\n📸 Fetching {len(unique_tiles)} unique tiles for {2 * len(jobs)} images...")
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        tiles = dict(zip(unique_tiles, executor.map(lambda t: fetcher.fetch_tile(*t, zoom), unique_tiles)))
+    
+    # Encode and write images in the background while samples are assembled
+    pending_saves = []
+    with ThreadPoolExecutor(max_workers=4) as save_pool:
+        for (city_code, i, sample, _), (pos_tile, neg_tile) in zip(jobs, tile_pairs):
+            # Tiles are shared between coinciding lookups and across samples, and
+            # Image.save isn't safe to run concurrently on one object, so each
+            # background save below gets its own copy
+            image = tiles[pos_tile]
+            neg_image = tiles[neg_tile]
             try:
-                print(f"  📸 Fetching image {i+1}/{len(vacant_samples)}...")
-                
-                # Fetch satellite image
-                image = fetcher.fetch_image(sample['bbox'])
-                
                 if image is None:
                     print(f"  ⚠️ Failed to fetch image for {city_code}_{i}")
                     continue
                 
                 # Save positive sample (vacant land)
-                pos_filename = f"{city_code}_{i:02d}_vacant.jpg"
+                pos_filename = f"{city_code}_{i:02d}_vacant.webp"
                 pos_path = images_dir / pos_filename
-                image.save(pos_path, quality=90)
                 
                 pos_sample = {
                     'image_path': str(pos_path),
@@ -445,17 +604,13 @@ def create_training_dataset():
                     'query': f"Analyze this satellite image of {sample['city_name']} and identify vacant spaces suitable for urban development.",
                     'answer': f"I can identify vacant land in this satellite image from {sample['city_name']}. The area shows undeveloped space of approximately {sample['area_sqm']:.0f} square meters that appears suitable for development. The vacant land is characterized by open space without existing buildings or dense infrastructure."
                 }
-                dataset_samples.append(pos_sample)
+                pos_future = save_pool.submit(image.copy().save, pos_path, "WEBP", quality=80, method=4)
+                pending_saves.append((pos_future, pos_sample))
                 
                 # Create negative sample (developed area)
-                bbox_shifted = [b + 0.008 for b in sample['bbox']]  # Shift ~900m
-                neg_image = fetcher.fetch_image(bbox_shifted)
-                
                 if neg_image:
-                    neg_filename = f"{city_code}_{i:02d}_developed.jpg"
+                    neg_filename = f"{city_code}_{i:02d}_developed.webp"
                     neg_path = images_dir / neg_filename
-                    neg_image.save(neg_path, quality=90)
-                    
                     neg_sample = {
                         'image_path': str(neg_path),
                         'city': sample['city_name'],
@@ -464,22 +619,30 @@ def create_training_dataset():
                         'query': f"Analyze this satellite image of {sample['city_name']} and identify vacant spaces suitable for urban development.",
                         'answer': f"In this satellite image from {sample['city_name']}, I can see developed urban area with existing buildings and infrastructure. There are no significant vacant spaces visible that would be suitable for new development."
                     }
-                    dataset_samples.append(neg_sample)
+                    neg_future = save_pool.submit(neg_image.copy().save, neg_path, "WEBP", quality=80, method=4)
+                    pending_saves.append((neg_future, neg_sample))
                 
-                print(f"  ✅ Processed sample {i+1}")
-                    
+                print(f"  ✅ Processed {city_code}_{i:02d}")
+            
             except Exception as e:
                 print(f"  ❌ Error processing {city_code}_{i}: {e}")
                 continue
-        
-        print(f"✅ Completed {city_code}: {len([s for s in dataset_samples if s['city_code'] == city_code])} samples")
+    
+    # Keep only samples whose image was actually written
+    dataset_samples = []
+    for future, saved_sample in pending_saves:
+        try:
+            future.result()
+            dataset_samples.append(saved_sample)
+        except Exception as e:
+            print(f"  ❌ Failed to save {saved_sample['image_path']}: {e}")
     
     print(f"\n📊 Dataset created: {len(dataset_samples)} total samples")
     
-    # Save metadata
-    df = pd.DataFrame(dataset_samples)
-    df.to_csv(output_path / "dataset_metadata.csv", index=False)
-    print(f"💾 Metadata saved to: {output_path / 'dataset_metadata.csv'}")
+    # Save metadata (Parquet keeps dtypes; reload with pd.read_parquet)
+    df = pd.DataFrame.from_records(dataset_samples)
+    df.to_parquet(output_path / "dataset_metadata.parquet", engine="pyarrow", compression="zstd")
+    print(f"💾 Metadata saved to: {output_path / 'dataset_metadata.parquet'}")
     
     return dataset_samples
 
@@ -487,16 +650,20 @@ def create_training_dataset():
 print("🚀 Starting dataset creation...")
 dataset_samples = create_training_dataset()
 
+# Count samples per (city, label) in a single pass
+from collections import Counter
+label_counts = Counter((s['city_code'], s['has_vacant_land']) for s in dataset_samples)
+vacant_count = sum(v for (_, has_vacant), v in label_counts.items() if has_vacant)
+
 print(f"\n📈 Dataset Summary:")
 print(f"  • Total samples: {len(dataset_samples)}")
-print(f"  • Vacant land samples: {len([s for s in dataset_samples if s['has_vacant_land']])}")
-print(f"  • Developed area samples: {len([s for s in dataset_samples if not s['has_vacant_land']])}")
+print(f"  • Vacant land samples: {vacant_count}")
+print(f"  • Developed area samples: {len(dataset_samples) - vacant_count}")
 
 # Show sample breakdown by city
-city_counts = {}
-for sample in dataset_samples:
-    city = sample['city_code']
-    city_counts[city] = city_counts.get(city, 0) + 1
+city_counts = Counter()
+for (city, _), v in label_counts.items():
+    city_counts[city] += v
 
 print(f"\n🏙️ Samples by city:")
 for city, count in city_counts.items():
@@ -527,8 +694,8 @@ def format_training_data(dataset_samples):
                 print(f"⚠️ Image not found: {sample['image_path']}")
                 continue
             
-            # Load image
-            image = Image.open(sample['image_path'])
+            # Keep only the path; the collator decodes each image per batch
+            image = sample['image_path']
             
             # Format for training
             formatted_sample = {
@@ -603,27 +770,35 @@ def setup_model_for_training(formatted_dataset):
         load_in_4bit=True,
         bnb_4bit_use_double_quant=True,
         bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.bfloat16
+        bnb_4bit_compute_dtype=torch.bfloat16,
+        bnb_4bit_quant_storage=torch.bfloat16
     )
     
+    # Cap GPU usage explicitly so device_map="auto" doesn't fragment the allocator
+    total_memory = torch.cuda.get_device_properties(0).total_memory
+    max_memory = {0: f"{int(total_memory * 0.9 / 1024**3)}GiB", "cpu": "32GiB"}
+    
     print("📥 Loading base model... (This may take a few minutes)")
     # Load model and processor
     model = Qwen2VLForConditionalGeneration.from_pretrained(
         model_id,
         device_map="auto",
+        max_memory=max_memory,
         torch_dtype=torch.bfloat16,
-        quantization_config=bnb_config
+        quantization_config=bnb_config,
+        attn_implementation=attn_implementation,
+        low_cpu_mem_usage=True
     )
-    processor = Qwen2VLProcessor.from_pretrained(model_id)
+    processor = get_processor(model_id)
     print("✅ Base model loaded!")
     
     # LoRA configuration
     peft_config = LoraConfig(
-        lora_alpha=16,
+        lora_alpha=32,  # keep alpha/r at 2.0
         lora_dropout=0.05,
-        r=8,
+        r=16,
         bias="none",
-        target_modules=["q_proj", "v_proj", "k_proj", "o_proj"],
+        target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
         task_type="CAUSAL_LM",
     )
     
@@ -632,6 +807,11 @@ def setup_model_for_training(formatted_dataset):
     print("🔧 LoRA adapters applied!")
     peft_model.print_trainable_parameters()
     
+    # Move the resident model objects out of the GC's reach so training-time
+    # collections only traverse new allocations
+    gc.collect()
+    gc.freeze()
+    
     # Training configuration
     training_args = SFTConfig(
         output_dir=output_dir,
@@ -639,8 +819,12 @@ def setup_model_for_training(formatted_dataset):
         per_device_train_batch_size=1,
         per_device_eval_batch_size=1,
         gradient_accumulation_steps=8,
-        gradient_checkpointing_kwargs={"use_reentrant": False},
-        optim="adamw_torch_fused",
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs={"use_reentrant": False},  # Required for torch.compile graph capture
+        torch_compile=True,
+        torch_compile_backend="inductor",
+        torch_compile_mode="reduce-overhead",
+        optim="paged_adamw_8bit",  # 8-bit optimizer states, paged to CPU when idle
         learning_rate=5e-5,
         logging_steps=5,
         eval_steps=20,
@@ -739,10 +923,10 @@ def test_finetuned_model():
         torch_dtype=torch.bfloat16,
         quantization_config=bnb_config,
         offload_folder="/content/offload",
-        low_cpu_mem_usage=True,
-        trust_remote_code=True
+        attn_implementation=attn_implementation,
+        low_cpu_mem_usage=True
     )
-    processor = Qwen2VLProcessor.from_pretrained(model_id)
+    processor = get_processor(model_id)
     
     # Load fine-tuned adapter with proper error handling
     try:
@@ -752,56 +936,68 @@ def test_finetuned_model():
         print(f"⚠️ Adapter loading failed: {e}")
         print("📝 Using base model for testing...")
     
-    def generate_response(sample):
+    def generate_responses(samples):
         try:
-            # Prepare input
-            text_input = processor.apply_chat_template(
-                sample['messages'][1:2],  # Skip system message
-                tokenize=False,
-                add_generation_prompt=True
-            )
+            # Only the user turn is used for generation, so leave the system message out entirely
+            user_turns = [sample['messages'][1:2] for sample in samples]
+            
+            # Prepare a single left-padded batch for all samples
+            text_inputs = [
+                processor.apply_chat_template(
+                    user_turn,
+                    tokenize=False,
+                    add_generation_prompt=True
+                )
+                for user_turn in user_turns
+            ]
             
-            image_inputs, _ = process_vision_info(sample['messages'])
+            image_inputs, _ = process_vision_info(user_turns)
             
+            # Left-pad per call; the processor is shared with the trainer, so don't mutate it
             model_inputs = processor(
-                text=[text_input],
+                text=text_inputs,
                 images=image_inputs,
+                padding=True,
+                padding_side="left",
                 return_tensors="pt",
             ).to("cuda")
             
             # Generate with reduced tokens to save memory
-            generated_ids = model.generate(**model_inputs, max_new_tokens=128, do_sample=False)
+            generated_ids = model.generate(
+                **model_inputs,
+                max_new_tokens=128,
+                do_sample=False,
+                num_beams=1,
+                use_cache=True
+            )
             
             # Decode
             trimmed_ids = [
                 out_ids[len(in_ids):] for in_ids, out_ids in zip(model_inputs.input_ids, generated_ids)
             ]
             
-            output_text = processor.batch_decode(
+            return processor.batch_decode(
                 trimmed_ids,
                 skip_special_tokens=True,
                 clean_up_tokenization_spaces=False
             )
             
-            return output_text[0]
-            
         except Exception as e:
-            return f"Error: {e}"
+            return [f"Error: {e}"] * len(samples)
     
     # Test with a few samples
     if 'eval_dataset' in locals() and len(eval_dataset) > 0:
         test_samples = eval_dataset[:3]  # Test first 3 samples
+        generated_texts = generate_responses(test_samples)
         
         print("\n" + "="*80)
         print("🎯 FINE-TUNED MODEL TEST RESULTS")
         print("="*80)
         
-        for i, sample in enumerate(test_samples):
+        for i, (sample, generated) in enumerate(zip(test_samples, generated_texts)):
             print(f"\n📋 Test {i+1}:")
             print(f"Query: {sample['messages'][1]['content'][1]['text'][:100]}...")
             print(f"\nExpected: {sample['messages'][2]['content'][0]['text'][:150]}...")
-            
-            generated = generate_response(sample)
             print(f"\nGenerated: {generated}")
             print("-" * 80)
         
@@ -863,6 +1059,55 @@ else:
 # ============================================================================
 # SNIPPET 13: DOWNLOAD RESULTS (Run last)
 # ============================================================================
+def zip_directory(src_dir: str, zip_path: str):
+    """Zip a directory, storing weight shards and already-compressed files without deflate"""
+    stored_suffixes = {'.safetensors', '.bin', '.pt', '.pth', '.webp', '.jpg', '.parquet'}
+    src_dir = Path(src_dir)
+    
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for file_path in sorted(src_dir.rglob('*')):
+            if not file_path.is_file():
+                continue
+            arcname = file_path.relative_to(src_dir)
+            if file_path.suffix in stored_suffixes:
+                # Weights and compressed media are near-incompressible; deflating them only burns CPU
+                zf.write(file_path, arcname, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(file_path, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+    
+    return zip_path
+
+def upload_to_object_storage(path: str, destination: str):
+    """Upload a file to S3 or GCS with large parallel/chunked transfers"""
+    bucket_name = os.environ["RESULTS_BUCKET"]
+    key = Path(path).name
+    chunk_size = 64 * 1024**2
+    
+    if destination == "s3":
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from google.colab import userdata
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=userdata.get('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=userdata.get('AWS_SECRET_ACCESS_KEY')
+        )
+        config = TransferConfig(
+            multipart_threshold=chunk_size,
+            multipart_chunksize=chunk_size,
+            max_concurrency=16
+        )
+        s3.upload_file(path, bucket_name, key, Config=config)
+        return f"s3://{bucket_name}/{key}"
+    
+    # GCS: resumable upload in 100MB chunks using the Colab user's credentials
+    from google.cloud import storage
+    from google.colab import auth
+    auth.authenticate_user()
+    blob = storage.Client().bucket(bucket_name).blob(key, chunk_size=100 * 1024**2)
+    blob.upload_from_filename(path)
+    return f"gs://{bucket_name}/{key}"
+
 def download_results():
     """Package and download the fine-tuned model"""
     print("📦 Preparing model for download...")
@@ -872,22 +1117,78 @@ def download_results():
     
     model_dir = "/content/qwen2-vl-vacant-land"
     
-    if os.path.exists(model_dir):
-        # Create zip file
-        print("🗜️ Creating zip file...")
-        shutil.make_archive("qwen2-vl-vacant-land", 'zip', model_dir)
+    # Optionally push results to Drive, the Hub, or object storage (s3/gcs) instead of
+    # downloading through the browser
+    destination = os.environ.get("RESULTS_DESTINATION", "download")
+    
+    # Check required settings up front so a missing one fails before any packaging
+    missing = []
+    if destination in ("s3", "gcs") and not os.environ.get("RESULTS_BUCKET"):
+        missing.append("RESULTS_BUCKET environment variable")
+    if destination == "hub" and not os.environ.get("HF_REPO_ID"):
+        missing.append("HF_REPO_ID environment variable")
+    if destination == "s3":
+        from google.colab import userdata
+        for secret in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            try:
+                userdata.get(secret)
+            except Exception:
+                missing.append(f"{secret} Colab secret")
+    if missing:
+        print(f"❌ RESULTS_DESTINATION={destination} needs: {', '.join(missing)}")
+        return
+    
+    if os.path.exists(model_dir) and destination == "drive":
+        from google.colab import drive
+        drive.mount('/content/drive')
+        drive_dir = '/content/drive/MyDrive/qwen2-vl-vacant-land'
+        print(f"📤 Copying model to {drive_dir}...")
+        shutil.copytree(model_dir, drive_dir, dirs_exist_ok=True)
+        print("✅ Model copied to Google Drive!")
         
-        # Download
-        print("📥 Starting download...")
-        files.download("qwen2-vl-vacant-land.zip")
-        print("✅ Model downloaded! (~2-3GB)")
+    elif os.path.exists(model_dir) and destination == "hub":
+        from huggingface_hub import HfApi
+        repo_id = os.environ["HF_REPO_ID"]
+        print(f"📤 Uploading model to huggingface.co/{repo_id}...")
+        api = HfApi()
+        api.create_repo(repo_id, private=True, exist_ok=True)
+        api.upload_folder(folder_path=model_dir, repo_id=repo_id)
+        print("✅ Model uploaded to Hugging Face Hub!")
         
-        # Also download training data
+    elif os.path.exists(model_dir) and destination in ("s3", "gcs"):
+        # Upload straight from the instance instead of relaying through the browser
+        print("🗜️ Creating zip file...")
+        uploads = [zip_directory(model_dir, "qwen2-vl-vacant-land.zip")]
         if os.path.exists("/content/training_data"):
             print("📦 Packaging training data...")
-            shutil.make_archive("training_data", 'zip', "/content/training_data")
-            files.download("training_data.zip")
-            print("✅ Training data downloaded!")
+            uploads.append(zip_directory("/content/training_data", "training_data.zip"))
+        
+        for path in uploads:
+            print(f"📤 Uploading {path}...")
+            print(f"✅ Uploaded to {upload_to_object_storage(path, destination)}")
+        
+    elif os.path.exists(model_dir):
+        # Package the model and the training data at the same time; they touch disjoint directories
+        with ThreadPoolExecutor(max_workers=2) as archive_pool:
+            print("🗜️ Creating zip file...")
+            model_future = archive_pool.submit(zip_directory, model_dir, "qwen2-vl-vacant-land.zip")
+            training_future = None
+            if os.path.exists("/content/training_data"):
+                print("📦 Packaging training data...")
+                training_future = archive_pool.submit(
+                    zip_directory, "/content/training_data", "training_data.zip"
+                )
+            
+            # Download (the training data keeps packaging in the background meanwhile);
+            # use RESULTS_DESTINATION=drive/hub/s3/gcs for faster transfers
+            print("📥 Starting download...")
+            files.download(model_future.result())
+            print("✅ Model downloaded! (~2-3GB)")
+            
+            # Also download training data
+            if training_future is not None:
+                files.download(training_future.result())
+                print("✅ Training data downloaded!")
         
         print("\n🎉 All files downloaded successfully!")
         print("📁 You now have:")
@@ -13,11 +13,27 @@ import sys
 
 packages = [
     "transformers", "torch", "torchvision", "accelerate", 
-    "bitsandbytes", "peft", "qwen-vl-utils", "pillow", "requests"
+    "pillow", "requests", "hf_transfer"
 ]
 
-for package in packages:
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "-U", "-q", package])
+# Their dependencies are covered by Colab's base image and the list above
+no_deps_packages = ["bitsandbytes", "peft"]
+
+# Resolve everything in one call; uv installs in parallel and is much faster than pip
+try:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "-q", "uv"])
+    installer = [sys.executable, "-m", "uv", "pip", "install", "--system", "-U", "-q"]
+except subprocess.CalledProcessError:
+    installer = [sys.executable, "-m", "pip", "install", "-U", "-q"]
+
+subprocess.check_call([*installer, *packages])
+subprocess.check_call([*installer, "--no-deps", *no_deps_packages])
+
+# FlashAttention-2 needs to build against the installed torch
+try:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "-q", "flash-attn", "--no-build-isolation"])
+except subprocess.CalledProcessError:
+    print("⚠️ flash-attn not available, falling back to SDPA attention")
 
 print("✅ Dependencies installed!")
 
@@ -25,6 +41,11 @@ print("✅ Dependencies installed!")
 # STEP 2: IMPORTS AND SETUP
 # ============================================================================
 import os
+
+# Use hf_transfer's multi-connection downloader for model files; must be set before importing HF libraries
+os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+os.environ["HF_HUB_DOWNLOAD_TIMEOUT"] = "60"
+
 import torch
 import gc
 from PIL import Image
@@ -36,11 +57,22 @@ from transformers import (
     Qwen2VLProcessor,
     BitsAndBytesConfig
 )
-from qwen_vl_utils import process_vision_info
+
+# Prefer FlashAttention-2, fall back to PyTorch's fused SDPA kernels
+try:
+    import flash_attn
+    attn_implementation = "flash_attention_2"
+except ImportError:
+    attn_implementation = "sdpa"
+
+# Allow TF32 for any remaining fp32 matmuls
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
 
 # Check GPU
 print(f"🚀 GPU: {torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'None'}")
 print(f"💾 Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+print(f"⚡ Attention: {attn_implementation}")
 
 # ============================================================================
 # STEP 3: UPLOAD YOUR DOWNLOADED FILES
@@ -54,11 +86,80 @@ uploaded = files.upload()
 
 # Extract files
 import zipfile
+import mmap
+import struct
+import zlib
+
+def extract_zip(zip_path, dest_dir, chunk_size=1024 * 1024, verify_crc=True):
+    """Extract a zip, copying stored members with sendfile and inflating deflated ones from an mmap"""
+    dest_dir = os.path.realpath(dest_dir)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref, open(zip_path, 'rb') as src:
+        src_fd = src.fileno()
+        zip_map = mmap.mmap(src_fd, 0, prot=mmap.PROT_READ)
+        try:
+            for info in zip_ref.infolist():
+                target = os.path.realpath(os.path.join(dest_dir, info.filename))
+                if not target.startswith(dest_dir + os.sep):
+                    print(f"⚠️ Skipping unsafe path: {info.filename}")
+                    continue
+                if info.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                
+                # Encrypted or unusual members go through zipfile as usual
+                if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    zip_ref.extract(info, dest_dir)
+                    continue
+                
+                # Member data starts after the local header and its variable-length fields
+                name_len, extra_len = struct.unpack('<HH', zip_map[info.header_offset + 26:info.header_offset + 30])
+                data_offset = info.header_offset + 30 + name_len + extra_len
+                
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                crc = 0
+                with open(target, 'wb') as dst:
+                    if info.compress_type == zipfile.ZIP_STORED:
+                        # Zero-copy from the zip straight into the destination file
+                        offset, remaining = data_offset, info.file_size
+                        while remaining > 0:
+                            sent = os.sendfile(dst.fileno(), src_fd, offset, remaining)
+                            if sent == 0:
+                                raise zipfile.BadZipFile(f"Unexpected end of archive in {info.filename}")
+                            offset += sent
+                            remaining -= sent
+                        written = os.fstat(dst.fileno()).st_size
+                        if verify_crc:
+                            end = data_offset + info.file_size
+                            for start in range(data_offset, end, chunk_size):
+                                crc = zlib.crc32(zip_map[start:min(start + chunk_size, end)], crc)
+                    else:
+                        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                        end = data_offset + info.compress_size
+                        written = 0
+                        for start in range(data_offset, end, chunk_size):
+                            data = decompressor.decompress(zip_map[start:min(start + chunk_size, end)])
+                            crc = zlib.crc32(data, crc)
+                            written += len(data)
+                            dst.write(data)
+                        data = decompressor.flush()
+                        crc = zlib.crc32(data, crc)
+                        written += len(data)
+                        dst.write(data)
+                
+                # Catch truncated or corrupted archives (e.g. an interrupted browser download)
+                if written != info.file_size:
+                    raise zipfile.BadZipFile(
+                        f"Size mismatch for {info.filename}: expected {info.file_size}, wrote {written}"
+                    )
+                if (verify_crc or info.compress_type != zipfile.ZIP_STORED) and crc != info.CRC:
+                    raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename}")
+        finally:
+            zip_map.close()
+
 for filename in uploaded.keys():
     if filename.endswith('.zip'):
         print(f"📦 Extracting {filename}...")
-        with zipfile.ZipFile(filename, 'r') as zip_ref:
-            zip_ref.extractall('/content/')
+        extract_zip(filename, '/content/')
 
 # ============================================================================
 # STEP 4: LOAD THE FINE-TUNED MODEL
@@ -74,28 +175,36 @@ def load_finetuned_model():
     model_id = "Qwen/Qwen2-VL-7B-Instruct"
     adapter_path = "/content/qwen2-vl-vacant-land"
     
-    # Quantization for memory efficiency
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.bfloat16,
-        llm_int8_enable_fp32_cpu_offload=True
-    )
+    # The 7B model fits in bf16 (~14GB) on larger GPUs; only quantize on small ones
+    load_kwargs = {"attn_implementation": attn_implementation}
+    if torch.cuda.get_device_properties(0).total_memory < 24 * 1024**3:
+        print("🗜️ Small GPU detected, loading in 4-bit...")
+        load_kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
     
-    # Load base model
+    # Download the base weights once with parallel hf_transfer connections
     print("📥 Loading base Qwen2-VL model...")
+    from huggingface_hub import snapshot_download
+    base_model_path = snapshot_download(model_id, max_workers=16, local_dir="/content/qwen2-vl-base")
+    
+    # Load base model
     model = Qwen2VLForConditionalGeneration.from_pretrained(
-        model_id,
+        base_model_path,
         device_map="auto",
         torch_dtype=torch.bfloat16,
-        quantization_config=bnb_config,
         low_cpu_mem_usage=True,
-        trust_remote_code=True
+        **load_kwargs
     )
     
+    # Preallocated KV cache so the decode loop can be compiled
+    model.generation_config.cache_implementation = "static"
+    
     # Load processor
-    processor = Qwen2VLProcessor.from_pretrained(model_id)
+    processor = Qwen2VLProcessor.from_pretrained(base_model_path)
     
     # Load fine-tuned adapter
     print("🔧 Loading fine-tuned adapter...")
@@ -114,57 +223,74 @@ model, processor = load_finetuned_model()
 # ============================================================================
 # STEP 5: TEST WITH SAMPLE IMAGES
 # ============================================================================
-def test_vacant_land_detection(image_url_or_path, location="urban area"):
-    """Test the model with an image"""
-    print(f"\n🧪 Testing vacant land detection for {location}...")
-    
-    # Load image
+def load_image(image_url_or_path):
+    """Load an image from a URL or local path"""
     if image_url_or_path.startswith('http'):
-        response = requests.get(image_url_or_path)
-        image = Image.open(BytesIO(response.content)).convert('RGB')
+        # Pillow needs a seekable file and would copy a raw stream into memory anyway,
+        # so read the body in 1MB chunks instead of requests' small default buffer
+        buffer = BytesIO()
+        with requests.get(image_url_or_path, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                buffer.write(chunk)
+        buffer.seek(0)
+        image = Image.open(buffer).convert('RGB')
         print("📸 Loaded image from URL")
     else:
         image = Image.open(image_url_or_path).convert('RGB')
         print("📸 Loaded local image")
     
-    # Prepare the conversation
-    messages = [
-        {
-            "role": "system",
-            "content": [{"type": "text", "text": "You are an expert urban planner and satellite imagery analyst specializing in identifying vacant land suitable for development."}]
-        },
+    # The vision encoder rescales anyway; shrinking large images early saves preprocessing
+    image.thumbnail((1024, 1024), Image.LANCZOS)
+    return image
+
+# The chat prompt is identical for every image apart from the location, so
+# render the template once and substitute the location per call
+PERSONA = "You are an expert urban planner and satellite imagery analyst specializing in identifying vacant land suitable for development."
+LOCATION_PLACEHOLDER = "<<LOCATION>>"
+PROMPT_TEMPLATE = processor.apply_chat_template(
+    [
         {
             "role": "user",
             "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": f"Analyze this satellite image of {location} and identify vacant spaces suitable for urban development. Describe what you see and assess development potential."}
+                {"type": "image"},
+                {"type": "text", "text": f"{PERSONA} Analyze this satellite image of {LOCATION_PLACEHOLDER} and identify vacant spaces suitable for urban development. Describe what you see and assess development potential."}
             ]
         }
-    ]
-    
-    # Process input
-    text_input = processor.apply_chat_template(
-        messages[1:2],  # Skip system message for input
-        tokenize=False,
-        add_generation_prompt=True
-    )
-    
-    image_inputs, _ = process_vision_info(messages)
+    ],
+    tokenize=False,
+    add_generation_prompt=True
+)
+
+def to_cuda(batch):
+    """Move processor outputs to the GPU through pinned memory without blocking"""
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor):
+            batch[key] = value.pin_memory().to("cuda", non_blocking=True)
+    return batch
+
+def generate_analyses(items):
+    """Generate analyses for a batch of (image, location) pairs in one generate call"""
+    # Only the location changes between prompts; images go straight to the image processor
+    text_inputs = [PROMPT_TEMPLATE.replace(LOCATION_PLACEHOLDER, location) for _, location in items]
+    image_inputs = [image for image, _ in items]
     
-    model_inputs = processor(
-        text=[text_input],
+    # Left-pad so every prompt ends right where generation starts
+    model_inputs = to_cuda(processor(
+        text=text_inputs,
         images=image_inputs,
+        padding=True,
+        padding_side="left",
         return_tensors="pt",
-    ).to("cuda")
+    ))
     
     # Generate response
-    print("🔄 Generating analysis...")
     with torch.no_grad():
         generated_ids = model.generate(
             **model_inputs, 
             max_new_tokens=200,
             do_sample=False,
-            temperature=0.1
+            use_cache=True
         )
     
     # Decode response
@@ -172,18 +298,31 @@ def test_vacant_land_detection(image_url_or_path, location="urban area"):
         out_ids[len(in_ids):] for in_ids, out_ids in zip(model_inputs.input_ids, generated_ids)
     ]
     
-    response = processor.batch_decode(
+    return processor.batch_decode(
         trimmed_ids,
         skip_special_tokens=True,
         clean_up_tokenization_spaces=False
-    )[0]
+    )
+
+def test_vacant_land_detection_batch(items):
+    """Test the model with a batch of (image, location) pairs in one generate call"""
+    print(f"\n🧪 Testing vacant land detection for {len(items)} images...")
+    
+    print("🔄 Generating analysis...")
+    responses = generate_analyses(items)
     
-    print("🎯 Analysis Result:")
-    print("-" * 60)
-    print(response)
-    print("-" * 60)
+    for (_, location), response in zip(items, responses):
+        print(f"\n🎯 Analysis Result ({location}):")
+        print("-" * 60)
+        print(response)
+        print("-" * 60)
     
-    return response
+    return responses
+
+def test_vacant_land_detection(image_url_or_path, location="urban area"):
+    """Test the model with an image"""
+    image = load_image(image_url_or_path)
+    return test_vacant_land_detection_batch([(image, location)])[0]
 
 # ============================================================================
 # STEP 6: RUN TESTS
@@ -191,24 +330,39 @@ def test_vacant_land_detection(image_url_or_path, location="urban area"):
 print("\n🚀 TESTING YOUR FINE-TUNED MODEL")
 print("=" * 50)
 
+# Start loading every known test image in the background so fetches overlap the upload step
+from concurrent.futures import ThreadPoolExecutor
+image_pool = ThreadPoolExecutor(max_workers=2)
+
+sample_url = "https://images.unsplash.com/photo-1486325212027-8081e485255e?w=800"
+sample_future = image_pool.submit(load_image, sample_url)
+
+training_images_path = Path("/content/training_data/images")
+training_futures = []
+if training_images_path.exists():
+    sample_images = sorted(training_images_path.glob("*.webp")) or sorted(training_images_path.glob("*.jpg"))
+    training_futures = [
+        (img_path, image_pool.submit(load_image, str(img_path)))
+        for img_path in sample_images[:2]
+    ]
+
+# Collect every test image first, then analyze them in one batch
+test_items = []
+
 # Test 1: Sample satellite image URL
 print("\n📋 Test 1: Sample Urban Area")
-sample_url = "https://images.unsplash.com/photo-1486325212027-8081e485255e?w=800"
 try:
-    test_vacant_land_detection(sample_url, "downtown urban area")
+    test_items.append((sample_future.result(), "downtown urban area"))
 except Exception as e:
     print(f"❌ Test 1 failed: {e}")
 
 # Test 2: Use training data if available
-training_images_path = Path("/content/training_data/images")
 if training_images_path.exists():
     print("\n📋 Test 2: Training Data Sample")
-    sample_images = list(training_images_path.glob("*.jpg"))[:2]
-    
-    for i, img_path in enumerate(sample_images):
+    for i, (img_path, future) in enumerate(training_futures):
         try:
             city_code = img_path.name.split('_')[0]
-            test_vacant_land_detection(str(img_path), f"Chinese city {city_code}")
+            test_items.append((future.result(), f"Chinese city {city_code}"))
         except Exception as e:
             print(f"❌ Training sample {i+1} failed: {e}")
 else:
@@ -221,11 +375,33 @@ try:
     uploaded_test = files.upload()
     for filename in uploaded_test.keys():
         if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            test_vacant_land_detection(f"/content/{filename}", "your uploaded area")
+            test_items.append((load_image(f"/content/{filename}"), "your uploaded area"))
             break
 except Exception as e:
     print(f"⚠️ Custom image test skipped: {e}")
 
+image_pool.shutdown(wait=False)
+
+# Run all collected tests in a single batched generate call
+if test_items:
+    try:
+        # Compile the forward pass (CUDA graphs via reduce-overhead). The test batch is
+        # generated only once, so that single pass does the compile and graph capture
+        print("🔥 Compiling model...")
+        eager_forward = model.forward
+        model.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+        try:
+            test_vacant_land_detection_batch(test_items)
+        except Exception as e:
+            # A dynamo or CUDA-graph failure shouldn't cost the test results
+            print(f"⚠️ Compiled run failed ({e}), retrying without compile...")
+            model.forward = eager_forward
+            test_vacant_land_detection_batch(test_items)
+    except Exception as e:
+        print(f"❌ Batched test failed: {e}")
+else:
+    print("\n⚠️ No test images available.")
+
 # ============================================================================
 # STEP 7: PERFORMANCE COMPARISON
 # ============================================================================